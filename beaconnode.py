@@ -34,7 +34,7 @@ from events import (
     ProduceGraphEvent,
     ValidatorInitializationEvent,
 )
-from helpers import queue_element_or_none
+from helpers import queue_element_or_none, int_as_bits
 from validator import Validator, ValidatorBuilder
 
 
@@ -243,8 +243,9 @@ class BeaconNode(Process):
     def handle_genesis_state(self, state: spec.BeaconState, marker=None):
         print(f"[BEACON NODE {self.counter}] Initialize state from Genesis State")
         self.state = state
+        pubkey_indices = dict()
         for validator in self.validators:
-            validator.index_from_state(state)
+            validator.index_from_state(state, pubkey_indices)
 
     def handle_genesis_block(self, block: spec.BeaconBlock, marker=None):
         print(
@@ -336,12 +337,13 @@ class BeaconNode(Process):
         # ep(target) == ep(now) => cp_justified == cp_source
         # <=> ep(target) != ep(now) v cp_justified == cp_source
         candidate_attestations = tuple(
-            attestation
-            for attestation in self.attestation_cache.attestations_not_seen_in_block(
-                min_slot_to_include, max_slot_to_include
+            self.attestation_cache.attestations_not_seen_in_block(
+                min_slot_to_include,
+                max_slot_to_include,
+                lambda attestation: attestation.data.target.epoch
+                != spec.get_current_epoch(head_state)
+                or head_state.current_justified_checkpoint == attestation.data.source,
             )
-            if attestation.data.target.epoch != spec.get_current_epoch(head_state)
-            or head_state.current_justified_checkpoint == attestation.data.source
         )
         block = spec.BeaconBlock(
             slot=head_state.slot,
@@ -560,10 +562,10 @@ class BeaconNode(Process):
             # Aggregate all known unaggregated attestations which represent
             # the same vote this Beacon Node and its validators attested for
             attestations_to_aggregate[committee] = [
-                attestationcache.attestation
+                attestationcache
                 for attestationcache in self.attestation_cache.cache_by_time.get(
-                    slot, dict()
-                ).get(committee, list())
+                    (slot, committee), list()
+                )
                 if committee in self.last_attestation_data
                 and attestationcache.attestation.data
                 == self.last_attestation_data[committee]
@@ -580,25 +582,27 @@ class BeaconNode(Process):
             ):
                 continue
 
-            aggregation_bits = list(
-                0 for _ in range(self.committee[self.current_slot][validator_index][2])
-            )
+            aggregation_bits = 0
 
             # Set all bits representing the validators inside the aggregated attestation
-            for attestation in attestations_to_aggregate[validator_committee]:
-                for idx, bit in enumerate(attestation.aggregation_bits):
-                    if bit:
-                        aggregation_bits[idx] = 1
-            # noinspection PyArgumentList
-            aggregation_bits = Bitlist[spec.MAX_VALIDATORS_PER_COMMITTEE](
-                *aggregation_bits
+            for attestationcache in attestations_to_aggregate[validator_committee]:
+                aggregation_bits |= attestationcache.aggregation_bits
+            aggregation_bits = int_as_bits(
+                Bitlist[spec.MAX_VALIDATORS_PER_COMMITTEE],
+                aggregation_bits,
+                self.committee[self.current_slot][validator_index][2],
             )
 
             attestation = spec.Attestation(
                 aggregation_bits=aggregation_bits,
                 data=self.last_attestation_data[validator_committee],
                 signature=spec.get_aggregate_signature(
-                    attestations_to_aggregate[validator_committee]
+                    [
+                        attestationcache.attestation
+                        for attestationcache in attestations_to_aggregate[
+                            validator_committee
+                        ]
+                    ]
                 ),
             )
             aggregate_and_proof = spec.get_aggregate_and_proof(
@@ -647,15 +651,16 @@ class BeaconNode(Process):
             self.__process_block_contents(cblock)
 
         # Process the new block now
+        root = spec.hash_tree_root(block.message)
         self.log(
             {
-                "root": spec.hash_tree_root(block.message),
+                "root": root,
                 "parent": block.message.parent_root,
                 "proposer": block.message.proposer_index,
             },
             "BlockRecv",
         )
-        self.block_cache.add_block(block)
+        self.block_cache.add_block(block, root)
         try:
             chain = self.block_cache.chain_for_block(block, self.store)
         except KeyError as e:
@@ -1118,21 +1123,23 @@ def get_leaf_blocks(
 
 
 def get_chain_blocks(store: spec.Store, base_block: spec.Root) -> Set[spec.Root]:
+    children_by_parent = get_children_by_parent(store)
     chain = set()
-    children = get_children(store, base_block)
+    children = children_by_parent.get(base_block, set())
     while len(children) > 0:
         chain = chain.union(children)
         new_children = set()
         for child in children:
-            new_children = new_children.union(get_children(store, child))
+            new_children = new_children.union(children_by_parent.get(child, set()))
         children = new_children
     return chain
 
 
-def get_children(store: spec.Store, parent: spec.Root) -> Set[spec.Root]:
-    children = set(
-        root for root, block in store.blocks.items() if block.parent_root == parent
-    )
+def get_children_by_parent(store: spec.Store) -> Dict[spec.Root, Set[spec.Root]]:
+    # Group all blocks by their parent once instead of searching the store for every block
+    children = dict()
+    for root, block in store.blocks.items():
+        children.setdefault(block.parent_root, set()).add(root)
     return children
 
 
@@ -1,5 +1,7 @@
+from bisect import bisect_left, insort
+from collections import OrderedDict, defaultdict
 from dataclasses import dataclass
-from typing import Dict, List, Set, Optional, Sequence, Iterable, Tuple
+from typing import DefaultDict, Dict, List, Set, Optional, Sequence, Iterable, Tuple
 
 from queue import Queue
 import traceback
@@ -8,6 +10,8 @@ from eth2spec.utils.ssz import ssz_typing
 
 from os import getpid
 
+from helpers import bits_as_int
+
 
 @dataclass
 class CachedAttestation:
@@ -18,6 +22,8 @@ class CachedAttestation:
     known_to_forkchoice: bool
     denied: True
     attestation: spec.Attestation
+    # Aggregation bits as integer bitmask, bit i set <=> i'th committee member attested
+    aggregation_bits: int
 
     def into_indexed_attestation(self) -> spec.IndexedAttestation:
         return spec.IndexedAttestation(
@@ -34,24 +40,44 @@ class CachedAttestation:
             seen_in_block=False,
             known_to_forkchoice=False,
             denied=False,
-            attestation=attestation
+            attestation=attestation,
+            aggregation_bits=bits_as_int(attestation.aggregation_bits),
         )
 
 
 class AttestationCache:
-    cache_by_time: Dict[spec.Slot, Dict[spec.CommitteeIndex, List[CachedAttestation]]]
+    cache_by_time: DefaultDict[
+        Tuple[spec.Slot, spec.CommitteeIndex], List[CachedAttestation]
+    ]
+    # Sorted keys of cache_by_time to find slot ranges without scanning all keys
+    time_keys: List[Tuple[spec.Slot, spec.CommitteeIndex]]
     cache_by_validator: Dict[spec.ValidatorIndex, List[CachedAttestation]]
+    # Attestations inside cache_by_time by their root, to find them without comparing whole containers
+    cache_by_root: Dict[spec.Root, CachedAttestation]
     queued_attestations: Queue
-    state_cache: Dict[spec.Epoch, Dict[spec.Root, spec.BeaconState]]
+    # Forwarded states, least recently used first
+    state_cache: Dict[Tuple[spec.Epoch, spec.Root], spec.BeaconState]
+    state_cache_size: int
     counter: int
 
-    def __init__(self, counter=-1):
-        self.cache_by_time = dict()
+    def __init__(self, counter=-1, state_cache_size=16):
+        self.cache_by_time = defaultdict(list)
+        self.time_keys = list()
         self.cache_by_validator = dict()
+        self.cache_by_root = dict()
         self.queued_attestations = None
-        self.state_cache = dict()
+        self.state_cache = OrderedDict()
+        self.state_cache_size = state_cache_size
         self.counter = counter
 
+    def __str__(self):
+        return (
+            f"AttestationCache(counter=[{self.counter}] "
+            f"slot_committees=[{len(self.cache_by_time)}] "
+            f"attestations=[{len(self.cache_by_root)}] "
+            f"states=[{len(self.state_cache)}])"
+        )
+
     # TODO do not immediately set the validators for future attestations. The committee is not known now!!
     def add_attestation(
         self,
@@ -90,22 +116,18 @@ class AttestationCache:
         )
 
         if attestation_slot_epoch > attestation_block_slot_epoch + 1:
-            if (
-                attestation_slot_epoch in self.state_cache
-                and attestation_block_root in self.state_cache[attestation_slot_epoch]
-            ):
-                attestation_block_state = self.state_cache[attestation_slot_epoch][
-                    attestation_block_root
-                ]
+            state_key = (attestation_slot_epoch, attestation_block_root)
+            if state_key in self.state_cache:
+                self.state_cache.move_to_end(state_key)
+                attestation_block_state = self.state_cache[state_key]
             else:
                 print(
                     f"[BEACON NODE {self.counter}][ATTESTATION CACHE] Attestation Cache needs to manually forward the state. epoch_block_slot=[{attestation_block_slot_epoch}] epoch_attestation_slot=[{attestation_slot_epoch}]"
                 )
                 spec.process_slots(attestation_block_state, attestation.data.slot)
-                self.__ensure_key_exists(self.state_cache, attestation_slot_epoch, dict)
-                self.state_cache[attestation_slot_epoch][
-                    attestation_block_root
-                ] = attestation_block_state
+                self.state_cache[state_key] = attestation_block_state
+                if len(self.state_cache) > self.state_cache_size:
+                    self.state_cache.popitem(last=False)
 
         cached_attestation = CachedAttestation.from_attestation(
             attestation, attestation_block_state
@@ -113,9 +135,10 @@ class AttestationCache:
         cached_attestation.seen_in_block = seen_in_block
         slot, committee = attestation.data.slot, attestation.data.index
 
-        self.__ensure_key_exists(self.cache_by_time, slot, dict)
-        self.__ensure_key_exists(self.cache_by_time[slot], committee, list)
-        self.cache_by_time[slot][committee].append(cached_attestation)
+        if (slot, committee) not in self.cache_by_time:
+            insort(self.time_keys, (slot, committee))
+        self.cache_by_time[(slot, committee)].append(cached_attestation)
+        self.cache_by_root[spec.hash_tree_root(attestation)] = cached_attestation
         for validator in cached_attestation.attesting_indices:
             self.__ensure_key_exists(self.cache_by_validator, validator, list)
             self.cache_by_validator[validator].append(cached_attestation)
@@ -169,50 +192,87 @@ class AttestationCache:
         )
 
     def attestations_not_seen_in_block(
-        self, min_slot: spec.Slot, max_slot: spec.Slot
+        self, min_slot: spec.Slot, max_slot: spec.Slot, filter_func=None
     ) -> Iterable[spec.Attestation]:
-        yield from self.filter_attestations(
-            min_slot, max_slot, lambda a: not a.seen_in_block and a.known_to_forkchoice and not a.denied
-        )
+        for key in self.time_keys_in_range(min_slot, max_slot):
+            attestations = self.cache_by_time[key]
+            # Skip attestations which would not add any validator not already included for the same vote
+            seen_bits: Dict[spec.Root, int] = dict()
+            for attestation in attestations:
+                if attestation.seen_in_block:
+                    data_root = spec.hash_tree_root(attestation.attestation.data)
+                    seen_bits[data_root] = (
+                        seen_bits.get(data_root, 0) | attestation.aggregation_bits
+                    )
+            for attestation in attestations:
+                if (
+                    attestation.seen_in_block
+                    or not attestation.known_to_forkchoice
+                    or attestation.denied
+                ):
+                    continue
+                # Only attestations which are going to be included may cover others
+                if filter_func is not None and not filter_func(attestation.attestation):
+                    continue
+                data_root = spec.hash_tree_root(attestation.attestation.data)
+                seen = seen_bits.get(data_root, 0)
+                if attestation.aggregation_bits & ~seen:
+                    seen_bits[data_root] = seen | attestation.aggregation_bits
+                    yield attestation.attestation
 
     def filter_attestations(
         self, min_slot: spec.Slot, max_slot: spec.Slot, filter_func
     ) -> Iterable[spec.Attestation]:
-        for slot in self.cache_by_time.keys():
-            if min_slot <= slot <= max_slot:
-                for committee, attestations in self.cache_by_time[slot].items():
-                    for attestation in attestations:
-                        if filter_func(attestation):
-                            yield attestation.attestation
+        for key in self.time_keys_in_range(min_slot, max_slot):
+            for attestation in self.cache_by_time[key]:
+                if filter_func(attestation):
+                    yield attestation.attestation
+
+    def time_keys_in_range(
+        self, min_slot: spec.Slot, max_slot: spec.Slot
+    ) -> Sequence[Tuple[spec.Slot, spec.CommitteeIndex]]:
+        # (slot,) sorts before every (slot, committee) key
+        lower = bisect_left(self.time_keys, (min_slot,))
+        upper = bisect_left(self.time_keys, (max_slot + 1,))
+        return self.time_keys[lower:upper]
 
     def cleanup_time_cache(self, min_slot: spec.Slot):
         self.cleanup_old_time_cache_attestations(min_slot)
         self.cleanup_redundant_time_cache_attestations()
 
     def cleanup_redundant_time_cache_attestations(self):
-        for slot, committee_list_dict in self.cache_by_time.items():
-            for committee in committee_list_dict.keys():
-                attestations = self.cache_by_time[slot][committee]
-                attestations.sort(key=lambda a: len(a.attesting_indices), reverse=True)
-                kept_attestations = []
-                validators_seen_in_kept_attestations = set()
-                for attestation in attestations:
-                    # Here be dragons. We dont compare fork choice-known or seen-in-block fields yet!
-                    if any(
-                        validator not in validators_seen_in_kept_attestations
-                        for validator in attestation.attesting_indices
-                    ):
-                        kept_attestations.append(attestation)
-                        for validator in attestation.attesting_indices:
-                            validators_seen_in_kept_attestations.add(validator)
-                self.cache_by_time[slot][committee] = kept_attestations
+        for slot_and_committee, attestations in self.cache_by_time.items():
+            kept_attestations = []
+            # Validators not yet covered by kept attestations, stored parallel to the candidates
+            candidates = [
+                attestation for attestation in attestations if attestation.aggregation_bits
+            ]
+            uncovered = [attestation.aggregation_bits for attestation in candidates]
+            # Greedy maximum coverage: always keep the attestation adding the most unseen validators
+            while candidates:
+                gains = [bin(bits).count("1") for bits in uncovered]
+                best = max(range(len(candidates)), key=gains.__getitem__)
+                # Here be dragons. We dont compare fork choice-known or seen-in-block fields yet!
+                kept_attestations.append(candidates[best])
+                newly_covered = uncovered[best]
+                remaining = [
+                    (attestation, bits & ~newly_covered)
+                    for attestation, bits in zip(candidates, uncovered)
+                ]
+                candidates = [attestation for attestation, bits in remaining if bits]
+                uncovered = [bits for _, bits in remaining if bits]
+            kept_ids = set(id(attestation) for attestation in kept_attestations)
+            self.__forget_attestations(
+                attestation for attestation in attestations if id(attestation) not in kept_ids
+            )
+            self.cache_by_time[slot_and_committee] = kept_attestations
 
     def cleanup_old_time_cache_attestations(self, min_slot: spec.Slot):
-        slots_to_clean = tuple(
-            slot for slot in self.cache_by_time.keys() if slot < min_slot
-        )
-        for slot in slots_to_clean:
-            del self.cache_by_time[slot]
+        lower = bisect_left(self.time_keys, (min_slot,))
+        for key in self.time_keys[:lower]:
+            self.__forget_attestations(self.cache_by_time[key])
+            del self.cache_by_time[key]
+        del self.time_keys[:lower]
 
     def search_slashings(
         self, state: spec.BeaconState, validator: Optional[spec.ValidatorIndex] = None
@@ -226,7 +286,7 @@ class AttestationCache:
     def int_search_slashings(
         self, state: spec.BeaconState, validator: spec.ValidatorIndex
     ) -> Iterable[spec.AttesterSlashing]:
-        slashed_validators = []
+        slashed_validators = set()
         for i in range(len(self.cache_by_validator[validator])):
             for j in range(i, len(self.cache_by_validator[validator])):
                 attestation1 = self.cache_by_validator[validator][i]
@@ -243,9 +303,11 @@ class AttestationCache:
                         yield spec.AttesterSlashing(
                             attestation_1=indexed_1, attestation_2=indexed_2
                         )
-                        slashed_validators += set(
-                            indexed_1.attesting_indices
-                        ).intersection(indexed_2.attesting_indices)
+                        slashed_validators.update(
+                            set(indexed_1.attesting_indices).intersection(
+                                indexed_2.attesting_indices
+                            )
+                        )
                 elif spec.is_slashable_attestation_data(
                     attestation2.attestation.data, attestation1.attestation.data
                 ):
@@ -258,19 +320,20 @@ class AttestationCache:
                         yield spec.AttesterSlashing(
                             attestation_1=indexed_2, attestation_2=indexed_1
                         )
-                        slashed_validators += set(
-                            indexed_1.attesting_indices
-                        ).intersection(indexed_2.attesting_indices)
+                        slashed_validators.update(
+                            set(indexed_1.attesting_indices).intersection(
+                                indexed_2.attesting_indices
+                            )
+                        )
 
     def __find_attestaion(
         self, attestation: spec.Attestation
     ) -> Optional[CachedAttestation]:
-        slot, committee = attestation.data.slot, attestation.data.index
-        if slot in self.cache_by_time and committee in self.cache_by_time[slot]:
-            for cached_attestation in self.cache_by_time[slot][committee]:
-                if cached_attestation.attestation == attestation:
-                    return cached_attestation
-        return None
+        return self.cache_by_root.get(spec.hash_tree_root(attestation))
+
+    def __forget_attestations(self, cached_attestations: Iterable[CachedAttestation]):
+        for cached_attestation in cached_attestations:
+            del self.cache_by_root[spec.hash_tree_root(cached_attestation.attestation)]
 
     @staticmethod
     def __ensure_key_exists(target: dict, key, default_generator):
@@ -280,36 +343,53 @@ class AttestationCache:
 
 class BlockCache:
     blocks: Dict[spec.Root, spec.SignedBeaconBlock]
-    accepted: List[Optional[spec.Root]]
+    accepted: Dict[spec.Slot, spec.Root]
+    accepted_roots: Set[spec.Root]
     outstanding: Set[spec.Root]
     slashable: Set[Tuple[spec.Root]]
+    root_cache: Dict[int, Tuple[spec.SignedBeaconBlock, spec.Root]]
+    children: Dict[spec.Root, List[spec.Root]]
 
     def __init__(self, genesis: spec.BeaconBlock):
         genesis_root = spec.hash_tree_root(genesis)
         signed_genesis = spec.SignedBeaconBlock(message=genesis)
         self.blocks = {genesis_root: signed_genesis}
-        # One 'None' for genesis (which is in fact not a signed beacon block)
-        self.accepted = [genesis_root]
+        self.accepted = {genesis.slot: genesis_root}
+        self.accepted_roots = {genesis_root}
         self.outstanding = set()
         self.slashable = set()
+        self.root_cache = {id(signed_genesis): (signed_genesis, genesis_root)}
+        self.children = {genesis.parent_root: [genesis_root]}
 
     def add_block(
         self, block: spec.SignedBeaconBlock, root: Optional[spec.Root] = None
     ):
         if root is None:
-            root = spec.hash_tree_root(block.message)
+            root = self.__root(block)
+        if root not in self.blocks:
+            self.children.setdefault(block.message.parent_root, list()).append(root)
+        else:
+            # A newly decoded copy replaces the stored block; forget the old object
+            self.root_cache.pop(id(self.blocks[root]), None)
         self.blocks[root] = block
-        if root in self.accepted:
+        self.root_cache[id(block)] = (block, root)
+        if root in self.accepted_roots:
             return
-        while len(self.accepted) <= block.message.slot:
-            self.accepted.append(None)
 
         self.outstanding.add(root)
-        block_root_current_slot = self.accepted[block.message.slot]
+        block_root_current_slot = self.accepted.get(block.message.slot)
         if block_root_current_slot is not None and not block_root_current_slot == root:
             self.slashable.add((block_root_current_slot, root))
             # raise ValueError('Second block at same height!')
 
+    def __root(self, block: spec.SignedBeaconBlock) -> spec.Root:
+        # Blocks are not modified after they are received, so their root can be reused.
+        # Only blocks held by self.blocks are cached: they stay alive, so their id cannot be recycled.
+        cached = self.root_cache.get(id(block))
+        if cached is not None and cached[0] is block:
+            return cached[1]
+        return spec.hash_tree_root(block.message)
+
     def search_slashings(
         self, state: spec.BeaconState
     ) -> Iterable[spec.ProposerSlashing]:
@@ -363,38 +443,28 @@ class BlockCache:
     def chain_for_block(
         self, block: spec.SignedBeaconBlock, store: spec.Store
     ) -> Sequence[spec.SignedBeaconBlock]:
-        root = spec.hash_tree_root(block.message)
+        root = self.__root(block)
         chain = []
-        self.__chain_for_block(block, root, chain, store)
+        # Walk towards genesis using the parent roots; no need to hash any ancestor
+        while root not in store.blocks and block.message.slot != 0:
+            chain.append(block)
+            parent_root = block.message.parent_root
+            if parent_root not in self.blocks:
+                raise KeyError(
+                    f"Parent block {parent_root} of block {root} not known"
+                )
+            block, root = self.blocks[parent_root], parent_root
+        chain.reverse()
         return chain
 
-    def __chain_for_block(
-        self,
-        block: spec.SignedBeaconBlock,
-        root: spec.Root,
-        chain: List[spec.SignedBeaconBlock],
-        store: spec.Store,
-    ):
-        if root in store.blocks:
-            return
-        if block.message.slot == 0:
-            return
-        if block.message.parent_root not in self.blocks:
-            raise KeyError(
-                f"Parent block {block.message.parent_root} of block {root} not known"
-            )
-        self.__chain_for_block(
-            self.blocks[block.message.parent_root],
-            block.message.parent_root,
-            chain,
-            store,
-        )
-        chain.append(block)
-
     def accept_block(self, *kargs: spec.SignedBeaconBlock):
         for block in kargs:
-            root = spec.hash_tree_root(block.message)
+            root = self.__root(block)
+            previous_root = self.accepted.get(block.message.slot)
+            if previous_root is not None:
+                self.accepted_roots.discard(previous_root)
             self.accepted[block.message.slot] = root
+            self.accepted_roots.add(root)
             if root in self.outstanding:
                 self.outstanding.remove(root)
 
@@ -406,21 +476,43 @@ class BlockCache:
     def longest_outstanding_chain(
         self, store: spec.Store
     ) -> Sequence[spec.SignedBeaconBlock]:
-        chain = []
-        for outstanding in (self.blocks[oblock] for oblock in self.outstanding):
-            try:
-                ochain = self.chain_for_block(outstanding, store)
-            except KeyError:
-                ochain = []
-            if len(ochain) >= len(chain):
-                chain = ochain
-        return chain
+        # Outstanding blocks mostly share their ancestors, so only count every block once
+        chain_lengths = dict()
+        longest_root, longest_length = None, 0
+        for oblock in self.outstanding:
+            length = self.__chain_length(oblock, store, chain_lengths)
+            if length >= longest_length:
+                longest_root, longest_length = oblock, length
+        if longest_length == 0:
+            return []
+        return self.chain_for_block(self.blocks[longest_root], store)
+
+    def __chain_length(
+        self,
+        root: spec.Root,
+        store: spec.Store,
+        chain_lengths: Dict[spec.Root, Optional[int]],
+    ) -> int:
+        # Same walk as chain_for_block; None marks chains with an unknown ancestor
+        path = []
+        while root not in chain_lengths:
+            block = self.blocks[root]
+            if root in store.blocks or block.message.slot == 0:
+                chain_lengths[root] = 0
+            elif block.message.parent_root not in self.blocks:
+                chain_lengths[root] = None
+            else:
+                path.append(root)
+                root = block.message.parent_root
+        length = chain_lengths[root]
+        for root in reversed(path):
+            if length is not None:
+                length += 1
+            chain_lengths[root] = length
+        return length if length is not None else 0
 
     def leafs_for_block(self, root: spec.Root) -> Sequence[spec.Root]:
-        children = list()
-        for blockroot, block in self.blocks.items():
-            if block.message.parent_root == root:
-                children.append(blockroot)
+        children = self.children.get(root, list())
         leafs = list()
         if len(children) == 0:
             leafs.append(root)
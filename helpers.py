@@ -8,21 +8,30 @@ from remerkleable.byte_arrays import ByteVector, Bytes32
 
 
 def popcnt(bitlist: Bitlist) -> uint64:
-    bits = uint64(0)
-    for bit in bitlist:
-        if bit:
-            bits += 1
-    return bits
+    return uint64(bin(bits_as_int(bitlist)).count("1"))
 
 
 def indices_inside_committee(bitlist: Bitlist) -> List[uint64]:
     indexes = list()
-    for i, bit in enumerate(bitlist):
-        if bit:
-            indexes.append(uint64(i))
+    bits = bits_as_int(bitlist)
+    while bits:
+        lowest = bits & -bits
+        indexes.append(uint64(lowest.bit_length() - 1))
+        bits ^= lowest
     return indexes
 
 
+def bits_as_int(bitlist: Bitlist) -> int:
+    # Serialized bitlists are little endian and carry a delimiter bit right after the last element
+    return int.from_bytes(bitlist.encode_bytes(), "little") & ~(1 << len(bitlist))
+
+
+def int_as_bits(bitlist_type, bits: int, length: int) -> Bitlist:
+    return bitlist_type.decode_bytes(
+        (bits | (1 << length)).to_bytes(length // 8 + 1, "little")
+    )
+
+
 def queue_element_or_none(queue: Queue) -> Optional[Any]:
     try:
         return queue.get(False)
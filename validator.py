@@ -1,6 +1,7 @@
+import os
 from pathlib import Path
 import random
-from typing import Optional, Tuple
+from typing import Dict, Optional, Set, Tuple
 
 from remerkleable.basic import uint64
 
@@ -22,6 +23,10 @@ class Validator:
 
     colorstep: int
 
+    # File names inside each key directory, listed once instead of checking every file on its own.
+    # Other processes may add keys later, so a missing name is confirmed on disk before generating keys.
+    keydir_files: Dict[str, Set[str]] = dict()
+
     def __init__(self, counter: int, startbalance: uint64, keydir: Optional[str]):
         self.index = None
         self.counter = counter
@@ -36,15 +41,28 @@ class Validator:
             idx = self.index if self.index is not None else self.counter
         return COLORS[idx % len(COLORS)]
 
-    def index_from_state(self, state: spec.BeaconState):
+    def index_from_state(
+        self,
+        state: spec.BeaconState,
+        pubkey_indices: Optional[Dict[BLSPubkey, spec.ValidatorIndex]] = None,
+    ):
         # Check whether counter matches
         if (
-            len(state.validators) >= self.counter
+            len(state.validators) > self.counter
             and state.validators[self.counter].pubkey == self.pubkey
         ):
             self.index = spec.ValidatorIndex(self.counter)
         else:
-            self.index = self.__find_index(state)
+            if pubkey_indices is None:
+                self.index = self.__find_index(state)
+            else:
+                # Lookup table is shared between validators and only built when needed
+                if len(pubkey_indices) == 0:
+                    pubkey_indices.update(
+                        (validator.pubkey, spec.ValidatorIndex(index))
+                        for index, validator in enumerate(state.validators)
+                    )
+                self.index = pubkey_indices.get(self.pubkey)
             print(
                 f"WARNING: Validator counter is not the same as ValidatorIndex. counter=[{self.counter}] index=[{self.index}]"
             )
@@ -64,11 +82,16 @@ class Validator:
         keys = None
         if keydir is not None:
             keys = Path(keydir)
+            if keydir not in Validator.keydir_files and keys.is_dir():
+                Validator.keydir_files[keydir] = set(os.listdir(keydir))
 
-        if keys is not None and keys.is_dir():
+        if keydir in Validator.keydir_files:
+            files = Validator.keydir_files[keydir]
             pubkey_file = keys / f"{counter}.pubkey"
             privkey_file = keys / f"{counter}.privkey"
-            if pubkey_file.is_file() and privkey_file.is_file():
+            if (pubkey_file.name in files or pubkey_file.is_file()) and (
+                privkey_file.name in files or privkey_file.is_file()
+            ):
                 if counter % 200 == 0:
                     print(f"[VALIDATOR# {counter}] Read keys from file")
                 pubkey = pubkey_file.read_bytes()
@@ -81,6 +104,10 @@ class Validator:
                 assert isinstance(pubkey_file, Path)
                 pubkey_file.write_bytes(pubkey)
                 privkey_file.write_text(str(privkey))
+                if keydir in Validator.keydir_files:
+                    Validator.keydir_files[keydir].update(
+                        (pubkey_file.name, privkey_file.name)
+                    )
         return privkey, pubkey
 
 